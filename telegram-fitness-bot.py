@@ -1,11 +1,12 @@
 import logging
 import sqlite3
-from datetime import datetime, timedelta
+import aiosqlite
+from datetime import time as dt_time
 import asyncio
+import itertools
+import time
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ContextTypes
-import os
-from collections import defaultdict
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -16,12 +17,50 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+DB_PATH = 'fitness_tracker.db'
+
+# One writer connection plus a pool of read-only connections, each with a 20 MB page cache
+DB_READERS = 3
+DB_CACHE_SIZE = -20000
+
+# Handlers and the completion flusher share the writer connection, so
+# transactions on it must not interleave
+_WRITE_LOCK = asyncio.Lock()
+
+# Challenge frequencies are stored as their index in FREQUENCY_NAMES
+FREQUENCY_NAMES = ('daily', 'weekly')
+FREQUENCIES = {name: i for i, name in enumerate(FREQUENCY_NAMES)}
+
+# Leaderboard results are reused for this many seconds; 'pending' holds the
+# in-flight query so concurrent /stats calls share it
+STATS_TTL = 300
+_STATS_CACHE = {'t': 0, 'v': None, 'pending': None}
+
+# Leaderboard icons for the top three; everyone else gets DEFAULT_MEDAL
+MEDALS = ("🥇", "🥈", "🥉")
+DEFAULT_MEDAL = "👤"
+
+# Completions are written in batches of up to FLUSH_BATCH rows,
+# collected for at most FLUSH_INTERVAL seconds
+FLUSH_INTERVAL = 0.25
+FLUSH_BATCH = 500
+
+# Rows per multi-row INSERT; two bound values each stays under
+# SQLite's default limit of 999 variables
+INSERT_CHUNK = 450
+
 # Database setup
 def init_db():
-    conn = sqlite3.connect('fitness_tracker.db')
+    conn = sqlite3.connect(DB_PATH)
     c = conn.cursor()
     
-    # Create tables
+    # WAL persists in the database file; the others are per-connection
+    c.execute('PRAGMA journal_mode=WAL')
+    c.execute('PRAGMA synchronous=NORMAL')
+    c.execute('PRAGMA temp_store=MEMORY')
+    
+    # Create tables in a single transaction
+    c.execute('BEGIN IMMEDIATE')
     c.execute('''CREATE TABLE IF NOT EXISTS users
                  (user_id INTEGER PRIMARY KEY, username TEXT, first_name TEXT)''')
     
@@ -29,8 +68,8 @@ def init_db():
                  (id INTEGER PRIMARY KEY AUTOINCREMENT,
                   user_id INTEGER,
                   challenge_text TEXT,
-                  frequency TEXT,
-                  created_at TIMESTAMP,
+                  frequency INTEGER,
+                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                   active BOOLEAN DEFAULT 1,
                   FOREIGN KEY (user_id) REFERENCES users (user_id))''')
     
@@ -38,76 +77,273 @@ def init_db():
                  (id INTEGER PRIMARY KEY AUTOINCREMENT,
                   user_id INTEGER,
                   challenge_id INTEGER,
-                  completed_at TIMESTAMP,
+                  completed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                   FOREIGN KEY (user_id) REFERENCES users (user_id),
                   FOREIGN KEY (challenge_id) REFERENCES challenges (id))''')
     
+    # Convert frequencies stored as text by older versions
+    c.execute('''UPDATE challenges
+                 SET frequency = CASE frequency WHEN 'daily' THEN 0 WHEN 'weekly' THEN 1 END
+                 WHERE frequency IN ('daily', 'weekly')''')
+    
+    # Each user has at most one active challenge; keep only the newest
+    # in case older databases hold duplicates
+    c.execute('''UPDATE challenges SET active = 0
+                 WHERE active = 1 AND id NOT IN
+                     (SELECT MAX(id) FROM challenges WHERE active = 1 GROUP BY user_id)''')
+    
+    # Indexes for the /check and /stats lookups; the unique partial index
+    # also enforces the one-active-challenge rule
+    c.execute('DROP INDEX IF EXISTS idx_challenges_user_active')
+    c.execute('''CREATE UNIQUE INDEX IF NOT EXISTS idx_one_active_challenge
+                 ON challenges (user_id) WHERE active = 1''')
+    
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_completions_user_time
+                 ON completions (user_id, completed_at)''')
+    
+    # Per-user completion counters for the leaderboard
+    c.execute('''CREATE TABLE IF NOT EXISTS user_stats
+                 (user_id INTEGER PRIMARY KEY,
+                  count_30d INTEGER NOT NULL DEFAULT 0,
+                  last_completion_at TIMESTAMP,
+                  FOREIGN KEY (user_id) REFERENCES users (user_id))''')
+    
+    # Backfill counters for users who completed challenges before the table existed
+    c.execute('''INSERT OR IGNORE INTO user_stats (user_id, count_30d, last_completion_at)
+                 SELECT user_id, COUNT(id), MAX(completed_at)
+                 FROM completions
+                 WHERE completed_at > datetime('now', '-30 days')
+                 GROUP BY user_id''')
+    
     conn.commit()
     conn.close()
 
+# SQL statements, defined once so the text is identical on every call and
+# sqlite3's per-connection statement cache can reuse the prepared statement.
+# Timestamps are taken by SQLite (CURRENT_TIMESTAMP, UTC) rather than Python;
+# they are spelled out in the inserts because tables created before the
+# column defaults were added have no default to fall back on
+SQL_ADD_USER = '''
+INSERT INTO users (user_id, username, first_name) VALUES (?, ?, ?)
+ON CONFLICT(user_id) DO UPDATE SET username = excluded.username,
+    first_name = excluded.first_name
+WHERE username IS NOT excluded.username
+    OR first_name IS NOT excluded.first_name
+'''
+
+SQL_DEACTIVATE_CHALLENGE = "UPDATE challenges SET active = 0 WHERE user_id = ? AND active = 1"
+
+SQL_ADD_CHALLENGE = "INSERT INTO challenges (user_id, challenge_text, frequency, created_at) VALUES (?, ?, ?, CURRENT_TIMESTAMP)"
+
+SQL_GET_ACTIVE = "SELECT id, challenge_text, frequency FROM challenges WHERE user_id = ? AND active = 1"
+
+SQL_ADD_COMPLETIONS = "INSERT INTO completions (user_id, challenge_id, completed_at) VALUES {}"
+
+SQL_UPSERT_USER_STATS = '''
+INSERT INTO user_stats (user_id, count_30d, last_completion_at) VALUES (?, ?, CURRENT_TIMESTAMP)
+ON CONFLICT(user_id) DO UPDATE SET count_30d = count_30d + excluded.count_30d,
+    last_completion_at = excluded.last_completion_at
+'''
+
+SQL_MONTHLY_STATS = '''
+SELECT u.first_name, u.username, s.count_30d
+FROM users u
+JOIN user_stats s ON u.user_id = s.user_id
+WHERE s.count_30d > 0
+ORDER BY s.count_30d DESC
+LIMIT 20
+'''
+
+# Only users with a non-zero counter can have completions rolling off
+SQL_REFRESH_USER_STATS = '''
+UPDATE user_stats
+SET count_30d = (SELECT COUNT(c.id) FROM completions c
+                 WHERE c.user_id = user_stats.user_id AND c.completed_at > datetime('now', '-30 days'))
+WHERE count_30d > 0
+'''
+
 # Database helper functions
-def add_user(user_id, username, first_name):
-    conn = sqlite3.connect('fitness_tracker.db')
-    c = conn.cursor()
-    c.execute("INSERT OR REPLACE INTO users VALUES (?, ?, ?)", 
-              (user_id, username, first_name))
-    conn.commit()
-    conn.close()
+async def add_user(db, user_id, username, first_name):
+    # Only touches the row when the name actually changed
+    async with _WRITE_LOCK:
+        try:
+            await db.execute(SQL_ADD_USER, (user_id, username, first_name))
+            await db.commit()
+        except Exception:
+            await db.rollback()
+            raise
 
-def add_challenge(user_id, challenge_text, frequency):
-    conn = sqlite3.connect('fitness_tracker.db')
-    c = conn.cursor()
-    # Deactivate previous challenges for this user
-    c.execute("UPDATE challenges SET active = 0 WHERE user_id = ?", (user_id,))
-    # Add new challenge
-    c.execute("INSERT INTO challenges (user_id, challenge_text, frequency, created_at) VALUES (?, ?, ?, ?)",
-              (user_id, challenge_text, frequency, datetime.now()))
-    conn.commit()
-    conn.close()
+async def add_challenge(db, user_id, challenge_text, frequency):
+    async with _WRITE_LOCK:
+        try:
+            await db.execute('BEGIN IMMEDIATE')
+            # Deactivate the previous challenge for this user
+            await db.execute(SQL_DEACTIVATE_CHALLENGE, (user_id,))
+            # Add new challenge
+            await db.execute(SQL_ADD_CHALLENGE, (user_id, challenge_text, FREQUENCIES[frequency]))
+            await db.commit()
+        except Exception:
+            await db.rollback()
+            raise
 
-def get_active_challenge(user_id):
-    conn = sqlite3.connect('fitness_tracker.db')
-    c = conn.cursor()
-    c.execute("SELECT id, challenge_text, frequency FROM challenges WHERE user_id = ? AND active = 1", 
-              (user_id,))
-    result = c.fetchone()
-    conn.close()
-    return result
+async def get_active_challenge(db, user_id):
+    async with db.execute(SQL_GET_ACTIVE, (user_id,)) as cur:
+        return await cur.fetchone()
 
-def record_completion(user_id, challenge_id):
-    conn = sqlite3.connect('fitness_tracker.db')
-    c = conn.cursor()
-    c.execute("INSERT INTO completions (user_id, challenge_id, completed_at) VALUES (?, ?, ?)",
-              (user_id, challenge_id, datetime.now()))
-    conn.commit()
-    conn.close()
+async def record_completion(queue, user_id, challenge_id):
+    # Written to the database by flush_completions
+    await queue.put((user_id, challenge_id))
 
-def get_monthly_stats():
-    conn = sqlite3.connect('fitness_tracker.db')
-    c = conn.cursor()
+async def write_completions(db, rows):
+    counts = {}
+    for user_id, _ in rows:
+        counts[user_id] = counts.get(user_id, 0) + 1
     
-    # Get completions from the last 30 days
-    thirty_days_ago = datetime.now() - timedelta(days=30)
+    async with _WRITE_LOCK:
+        try:
+            await db.execute('BEGIN')
+            for i in range(0, len(rows), INSERT_CHUNK):
+                chunk = rows[i:i + INSERT_CHUNK]
+                placeholders = ", ".join(["(?, ?, CURRENT_TIMESTAMP)"] * len(chunk))
+                await db.execute(SQL_ADD_COMPLETIONS.format(placeholders),
+                                 [value for row in chunk for value in row])
+            await db.executemany(SQL_UPSERT_USER_STATS,
+                                 list(counts.items()))
+            await db.commit()
+        except Exception:
+            await db.rollback()
+            raise
+
+async def flush_completions(db, queue):
+    """Write queued completions in batches, one transaction per batch."""
+    loop = asyncio.get_running_loop()
+    while True:
+        rows = [await queue.get()]
+        deadline = loop.time() + FLUSH_INTERVAL
+        while len(rows) < FLUSH_BATCH:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                rows.append(await asyncio.wait_for(queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        
+        try:
+            await write_completions(db, rows)
+        except Exception:
+            logger.exception("Failed to write %d completions", len(rows))
+        finally:
+            for _ in rows:
+                queue.task_done()
+
+def format_leaderboard_line(rank, row):
+    medal = MEDALS[rank] if rank < len(MEDALS) else DEFAULT_MEDAL
+    name = row['first_name'] or row['username'] or 'Unknown'
+    return f"{medal} {name}: {row['count_30d']} completions"
+
+async def get_monthly_stats(db):
+    # Counters are kept current by record_completion and refresh_user_stats.
+    # Rows are formatted as the cursor streams them instead of fetched all at once
+    lines = []
+    async with db.execute(SQL_MONTHLY_STATS) as cur:
+        async for row in cur:
+            lines.append(format_leaderboard_line(len(lines), row))
+    return lines
+
+async def _load_leaderboard(db):
+    try:
+        stats = await get_monthly_stats(db)
+        _STATS_CACHE['t'] = time.monotonic()
+        _STATS_CACHE['v'] = stats
+        return stats
+    finally:
+        _STATS_CACHE['pending'] = None
+
+async def get_leaderboard(context: ContextTypes.DEFAULT_TYPE):
+    """Return the cached leaderboard, running at most one query at a time to refresh it."""
+    if _STATS_CACHE['v'] is not None and time.monotonic() - _STATS_CACHE['t'] < STATS_TTL:
+        return _STATS_CACHE['v']
     
-    query = '''
-    SELECT u.first_name, u.username, COUNT(c.id) as completion_count
-    FROM users u
-    LEFT JOIN completions c ON u.user_id = c.user_id 
-        AND c.completed_at > ?
-    GROUP BY u.user_id
-    ORDER BY completion_count DESC
-    '''
+    if _STATS_CACHE['pending'] is None:
+        _STATS_CACHE['pending'] = asyncio.create_task(_load_leaderboard(get_reader(context)))
+    # Shielded so one cancelled caller doesn't cancel the query for the others
+    return await asyncio.shield(_STATS_CACHE['pending'])
+
+async def refresh_user_stats(context: ContextTypes.DEFAULT_TYPE):
+    """Roll completions older than 30 days off the leaderboard counters"""
+    db = context.bot_data['db_writer']
     
-    c.execute(query, (thirty_days_ago,))
-    results = c.fetchall()
-    conn.close()
-    return results
+    async with _WRITE_LOCK:
+        try:
+            await db.execute(SQL_REFRESH_USER_STATS)
+            await db.commit()
+        except Exception:
+            await db.rollback()
+            raise
+    _STATS_CACHE['v'] = None
+
+async def connect_db(database, **kwargs):
+    db = await aiosqlite.connect(database, cached_statements=256, **kwargs)
+    db.row_factory = aiosqlite.Row
+    try:
+        await db.execute('PRAGMA synchronous=NORMAL')
+        await db.execute('PRAGMA temp_store=MEMORY')
+        await db.execute(f'PRAGMA cache_size={DB_CACHE_SIZE}')
+    except Exception:
+        await db.close()
+        raise
+    return db
+
+def get_reader(context: ContextTypes.DEFAULT_TYPE):
+    """Pick the next read-only connection, round-robin."""
+    return next(context.bot_data['db_reader_cycle'])
+
+async def open_db(application: Application):
+    """Open the shared database connections once the bot starts.
+
+    Each resource is stored in bot_data as soon as it exists, so close_db can
+    release whatever was opened if startup fails part way.
+    """
+    # Schema setup is the only blocking sqlite3 call left; keep it off the event loop
+    await asyncio.to_thread(init_db)
+    
+    # The writer goes first so the WAL files exist for the read-only connections
+    db = await connect_db(DB_PATH)
+    application.bot_data['db_writer'] = db
+    
+    readers = []
+    application.bot_data['db_readers'] = readers
+    for _ in range(DB_READERS):
+        readers.append(await connect_db(f'file:{DB_PATH}?mode=ro', uri=True))
+    application.bot_data['db_reader_cycle'] = itertools.cycle(readers)
+    
+    queue = asyncio.Queue()
+    application.bot_data['completion_queue'] = queue
+    application.bot_data['completion_flusher'] = asyncio.create_task(flush_completions(db, queue))
+
+async def close_db(application: Application):
+    """Close the shared database connections on shutdown."""
+    # Also runs after a failed startup, so skip anything open_db never created
+    bot_data = application.bot_data
+    
+    flusher = bot_data.get('completion_flusher')
+    if flusher is not None:
+        # Let pending completions reach the database first
+        await bot_data['completion_queue'].join()
+        flusher.cancel()
+    
+    for reader in bot_data.get('db_readers', []):
+        await reader.close()
+    
+    writer = bot_data.get('db_writer')
+    if writer is not None:
+        await writer.close()
 
 # Bot command handlers
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Send a message when the command /start is issued."""
     user = update.effective_user
-    add_user(user.id, user.username, user.first_name)
     
     keyboard = [
         [
@@ -117,11 +353,15 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
-    await update.message.reply_text(
-        f'Hi {user.first_name}! 💪\n\n'
-        'Welcome to the Fitness Tracker Bot!\n'
-        'Choose your challenge frequency:',
-        reply_markup=reply_markup
+    # The reply doesn't depend on the user row, so send both at once
+    await asyncio.gather(
+        add_user(context.bot_data['db_writer'], user.id, user.username, user.first_name),
+        update.message.reply_text(
+            f'Hi {user.first_name}! 💪\n\n'
+            'Welcome to the Fitness Tracker Bot!\n'
+            'Choose your challenge frequency:',
+            reply_markup=reply_markup
+        )
     )
 
 async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -137,17 +377,8 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
     elif query.data.startswith('complete_'):
         challenge_id = int(query.data.split('_')[1])
-        record_completion(query.from_user.id, challenge_id)
+        await record_completion(context.bot_data['completion_queue'], query.from_user.id, challenge_id)
         await query.edit_message_text("✅ Great job! Challenge marked as complete!")
-        
-        # Schedule next reminder
-        frequency = context.user_data.get('current_frequency', 'daily')
-        if frequency == 'daily':
-            next_time = datetime.now() + timedelta(days=1)
-        else:
-            next_time = datetime.now() + timedelta(weeks=1)
-        
-        # You would implement the scheduling logic here
 
 async def receive_challenge(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle the challenge text from user"""
@@ -161,12 +392,14 @@ async def receive_challenge(update: Update, context: ContextTypes.DEFAULT_TYPE):
     frequency = context.user_data['frequency']
     user_id = update.effective_user.id
     
-    add_challenge(user_id, challenge_text, frequency)
-    
-    await update.message.reply_text(
-        f"✅ Challenge set!\n\n"
-        f"📋 Your {frequency} challenge: {challenge_text}\n\n"
-        f"I'll remind you {frequency} to check in on your progress!"
+    # Save the challenge while the confirmation is on its way
+    await asyncio.gather(
+        add_challenge(context.bot_data['db_writer'], user_id, challenge_text, frequency),
+        update.message.reply_text(
+            f"✅ Challenge set!\n\n"
+            f"📋 Your {frequency} challenge: {challenge_text}\n\n"
+            f"I'll remind you {frequency} to check in on your progress!"
+        )
     )
     
     # Clear the frequency from user data
@@ -175,7 +408,7 @@ async def receive_challenge(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def check_progress(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Manual progress check"""
     user_id = update.effective_user.id
-    challenge = get_active_challenge(user_id)
+    challenge = await get_active_challenge(get_reader(context), user_id)
     
     if not challenge:
         await update.message.reply_text(
@@ -183,51 +416,44 @@ async def check_progress(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
     
-    challenge_id, challenge_text, frequency = challenge
+    # int() because older tables declare the column TEXT and hand back '0'/'1'
+    frequency = FREQUENCY_NAMES[int(challenge['frequency'])]
     
     keyboard = [[
-        InlineKeyboardButton("✅ Yes, completed!", callback_data=f'complete_{challenge_id}'),
+        InlineKeyboardButton("✅ Yes, completed!", callback_data=f'complete_{challenge["id"]}'),
         InlineKeyboardButton("❌ Not yet", callback_data='not_complete')
     ]]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
     await update.message.reply_text(
         f"Did you complete your {frequency} challenge?\n\n"
-        f"📋 {challenge_text}",
+        f"📋 {challenge['challenge_text']}",
         reply_markup=reply_markup
     )
 
 async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show monthly statistics"""
-    stats = get_monthly_stats()
+    lines = await get_leaderboard(context)
     
-    if not stats:
+    if not lines:
         await update.message.reply_text("No statistics available yet!")
         return
     
-    message = "🏆 **Monthly Leaderboard** (Last 30 days)\n\n"
-    
-    for i, (first_name, username, count) in enumerate(stats, 1):
-        name = first_name or username or "Unknown"
-        emoji = "🥇" if i == 1 else "🥈" if i == 2 else "🥉" if i == 3 else "👤"
-        message += f"{emoji} {name}: {count} completions\n"
+    message = "🏆 **Monthly Leaderboard** (Last 30 days)\n\n" + "\n".join(lines)
     
     await update.message.reply_text(message, parse_mode='Markdown')
 
-async def remind_users(context: ContextTypes.DEFAULT_TYPE):
-    """Send reminders to users based on their schedule"""
-    # This function would be called periodically to check which users need reminders
-    # Implementation would depend on your scheduling needs
-    pass
-
 def main():
     """Start the bot."""
-    # Initialize database
-    init_db()
-    
     # Create the Application
     # Replace 'YOUR_BOT_TOKEN' with your actual bot token
-    application = Application.builder().token("BOT_TOKEN").build()
+    application = (
+        Application.builder()
+        .token("BOT_TOKEN")
+        .post_init(open_db)
+        .post_shutdown(close_db)
+        .build()
+    )
 
     # Register command handlers
     application.add_handler(CommandHandler("start", start))
@@ -242,6 +468,13 @@ def main():
         filters.TEXT & ~filters.COMMAND, receive_challenge
     ))
 
+    # Recompute leaderboard counters once a day; needs python-telegram-bot[job-queue]
+    if application.job_queue is not None:
+        application.job_queue.run_daily(refresh_user_stats, time=dt_time(hour=3))
+    else:
+        logger.warning("No job queue available; leaderboard counters will not roll off old completions. "
+                       "Install python-telegram-bot[job-queue] to enable the daily refresh.")
+
     # Run the bot until the user presses Ctrl-C
     application.run_polling(allowed_updates=Update.ALL_TYPES)
 